@@ -1,5 +1,11 @@
+import hashlib
+import json
+import logging
 import os
-from typing import Any, Callable, Dict, Optional, Sequence
+import re
+import threading
+from concurrent.futures import FIRST_EXCEPTION, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional, Sequence, cast
 
 import requests
 
@@ -34,6 +40,133 @@ DEFAULT_LLAMA_CPP_MODEL = (
     "https://huggingface.co/TheBloke/Llama-2-13B-chat-GGML/resolve"
     "/main/llama-2-13b-chat.ggmlv3.q4_0.bin"
 )
+DOWNLOAD_NUM_CONNECTIONS = 8
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # 8 MB
+# llama.cpp clamps the offloaded layer count to the model's number of layers
+ALL_GPU_LAYERS = 1000
+
+_MODEL_LOAD_EXECUTOR = ThreadPoolExecutor(thread_name_prefix="llama_cpp_load")
+
+logger = logging.getLogger(__name__)
+
+# only warn once per process about the missing tensor-core build
+_warned_missing_tensorcores = False
+
+
+def _identity_completion_to_prompt(completion: str) -> str:
+    return completion
+
+
+def _import_llama_cpp(tensorcores: bool, n_gpu_layers: int) -> Any:
+    """Import llama-cpp-python, preferring the tensor-core CUDA build."""
+    global _warned_missing_tensorcores
+    if tensorcores:
+        try:
+            import llama_cpp_cuda_tensorcores
+
+            return llama_cpp_cuda_tensorcores
+        except ImportError:
+            pass
+
+    try:
+        import llama_cpp
+    except ImportError:
+        raise ImportError(
+            "Could not import llama_cpp library."
+            "Please install llama_cpp with `pip install llama-cpp-python`."
+            "See the full installation guide for GPU support at "
+            "`https://github.com/abetlen/llama-cpp-python`"
+        )
+
+    supports_gpu_offload = getattr(
+        llama_cpp.llama_cpp, "llama_supports_gpu_offload", lambda: False
+    )
+    if (
+        tensorcores
+        and n_gpu_layers != 0
+        and not _warned_missing_tensorcores
+        and supports_gpu_offload()
+    ):
+        _warned_missing_tensorcores = True
+        logger.warning(
+            "Tensor-core kernels were requested, but `llama_cpp_cuda_tensorcores` "
+            "is not installed. Falling back to `llama_cpp`, which may use the "
+            "slower MMQ kernels on Ampere or newer GPUs."
+        )
+    return llama_cpp
+
+
+def _head(url: str) -> Optional[requests.Response]:
+    """Send a HEAD request, returning None if the server does not allow it."""
+    try:
+        response = requests.head(url, allow_redirects=True)
+        response.raise_for_status()
+    except requests.RequestException:
+        return None
+    return response
+
+
+def _load_download_state(state_path: str, total_size: int) -> List[List[int]]:
+    """Load the remaining byte ranges of a partial download, if still valid."""
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return []
+    if state.get("size") != total_size:
+        return []
+    return state["ranges"]
+
+
+def _linked_sha256(response: requests.Response) -> Optional[str]:
+    """Get the SHA256 that Hugging Face reports for LFS files, if any."""
+    for r in (*response.history, response):
+        etag = r.headers.get("X-Linked-Etag", "").strip('"')
+        if re.fullmatch("[0-9a-f]{64}", etag):
+            return etag
+    return None
+
+
+def _file_sha256(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(DOWNLOAD_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _is_downloaded(model_path: str) -> bool:
+    """Check if a model was fully downloaded, without hitting the network."""
+    try:
+        size = os.stat(model_path).st_size
+    except FileNotFoundError:
+        return False
+
+    # compare against the size recorded when the download completed
+    try:
+        with open(model_path + ".size") as f:
+            return size == int(f.read())
+    except (OSError, ValueError):
+        return size >= 1000 * 1000
+
+
+def _load_model(
+    llama_cpp: Any,
+    model_path: str,
+    model_kwargs: Dict[str, Any],
+    prompt_cache_capacity: Optional[int],
+) -> Any:
+    # NOTE: only newer (GGUF) llama-cpp-python versions treat -1 as all layers,
+    # older ones would offload nothing
+    if model_kwargs["n_gpu_layers"] < 0:
+        model_kwargs = {**model_kwargs, "n_gpu_layers": ALL_GPU_LAYERS}
+    model = llama_cpp.Llama(model_path=model_path, **model_kwargs)
+
+    # NOTE: llama.cpp already skips the shared prefix of consecutive calls;
+    # the RAM cache also keeps KV states of interleaved conversations
+    if prompt_cache_capacity is not None:
+        model.set_cache(llama_cpp.LlamaRAMCache(capacity_bytes=prompt_cache_capacity))
+    return model
 
 
 class LlamaCPP(CustomLLM):
@@ -41,6 +174,9 @@ class LlamaCPP(CustomLLM):
     model_path: Optional[str] = Field(
         description="The path to the llama-cpp model to use."
     )
+    model_sha256: Optional[str] = Field(
+        description="The expected SHA256 of the model downloaded from model_url."
+    )
     temperature: float = Field(description="The temperature to use for sampling.")
     max_new_tokens: int = Field(description="The maximum number of tokens to generate.")
     context_window: int = Field(
@@ -59,13 +195,43 @@ class LlamaCPP(CustomLLM):
         default_factory=dict, description="Kwargs used for model initialization."
     )
     verbose: bool = Field(description="Whether to print verbose output.")
+    n_gpu_layers: int = Field(
+        description=(
+            "The number of layers to offload to the GPU. "
+            "Negative values offload all layers."
+        )
+    )
+    n_batch: int = Field(description="The batch size used for prompt processing.")
+    tensor_split: Optional[List[float]] = Field(
+        description="How to split the model across multiple GPUs."
+    )
+    main_gpu: int = Field(description="The GPU used for scratch and small tensors.")
+    use_mlock: bool = Field(description="Whether to lock the model in memory.")
+    use_mmap: bool = Field(description="Whether to memory-map the model file.")
+    f16_kv: bool = Field(description="Whether to store the KV cache in float16.")
+    type_k: Optional[int] = Field(
+        description="The ggml type of the K cache (e.g. 8 for Q8_0, 2 for Q4_0)."
+    )
+    type_v: Optional[int] = Field(
+        description="The ggml type of the V cache (e.g. 8 for Q8_0, 2 for Q4_0)."
+    )
+    tensorcores: bool = Field(
+        description="Whether to prefer the tensor-core CUDA build of llama.cpp."
+    )
+    prompt_cache_capacity: Optional[int] = Field(
+        description=(
+            "The size in bytes of the in-memory KV cache reused across prompts "
+            "sharing a prefix. Disabled if None."
+        )
+    )
 
-    _model: Any = PrivateAttr()
+    _model_future: "Future[Any]" = PrivateAttr()
 
     def __init__(
         self,
         model_url: str = DEFAULT_LLAMA_CPP_MODEL,
         model_path: Optional[str] = None,
+        model_sha256: Optional[str] = None,
         temperature: float = 0.1,
         max_new_tokens: int = DEFAULT_NUM_OUTPUTS,
         context_window: int = DEFAULT_CONTEXT_WINDOW,
@@ -75,19 +241,41 @@ class LlamaCPP(CustomLLM):
         generate_kwargs: Optional[Dict[str, Any]] = None,
         model_kwargs: Optional[Dict[str, Any]] = None,
         verbose: bool = True,
+        n_gpu_layers: int = -1,
+        n_batch: int = 512,
+        tensor_split: Optional[List[float]] = None,
+        main_gpu: int = 0,
+        use_mlock: bool = False,
+        use_mmap: bool = True,
+        f16_kv: bool = True,
+        type_k: Optional[int] = None,
+        type_v: Optional[int] = None,
+        tensorcores: bool = True,
+        prompt_cache_capacity: Optional[int] = None,
     ) -> None:
-        try:
-            from llama_cpp import Llama
-        except ImportError:
-            raise ImportError(
-                "Could not import llama_cpp library."
-                "Please install llama_cpp with `pip install llama-cpp-python`."
-                "See the full installation guide for GPU support at "
-                "`https://github.com/abetlen/llama-cpp-python`"
-            )
-
         model_kwargs = model_kwargs or {}
         model_kwargs.update({"n_ctx": context_window, "verbose": verbose})
+        model_kwargs.setdefault("n_gpu_layers", n_gpu_layers)
+        if not isinstance(model_kwargs["n_gpu_layers"], int):
+            raise ValueError(
+                "n_gpu_layers must be an integer, "
+                f"got {model_kwargs['n_gpu_layers']!r}."
+            )
+        model_kwargs.setdefault("n_batch", n_batch)
+        model_kwargs.setdefault("main_gpu", main_gpu)
+        model_kwargs.setdefault("use_mlock", use_mlock)
+        model_kwargs.setdefault("use_mmap", use_mmap)
+        model_kwargs.setdefault("f16_kv", f16_kv)
+        if tensor_split is not None:
+            model_kwargs.setdefault("tensor_split", tensor_split)
+        if type_k is not None:
+            model_kwargs.setdefault("type_k", type_k)
+        if type_v is not None:
+            model_kwargs.setdefault("type_v", type_v)
+
+        # NOTE: tensor-core kernels are selected at build time, so we pick the
+        # `llama_cpp_cuda_tensorcores` wheel when it is installed
+        llama_cpp = _import_llama_cpp(tensorcores, model_kwargs["n_gpu_layers"])
 
         # check if model is cached
         if model_path is not None:
@@ -96,22 +284,16 @@ class LlamaCPP(CustomLLM):
                     "Provided model path does not exist. "
                     "Please check the path or provide a model_url to download."
                 )
-            else:
-                self._model = Llama(model_path=model_path, **model_kwargs)
         else:
             cache_dir = get_cache_dir()
             model_name = os.path.basename(model_url)
             model_path = os.path.join(cache_dir, "models", model_name)
-            if not os.path.exists(model_path):
+            if not _is_downloaded(model_path):
                 os.makedirs(os.path.dirname(model_path), exist_ok=True)
-                self._download_url(model_url, model_path)
-                assert os.path.exists(model_path)
-
-            self._model = Llama(model_path=model_path, **model_kwargs)
+                self._download_url(model_url, model_path, model_sha256)
 
-        model_path = model_path
         messages_to_prompt = messages_to_prompt or generic_messages_to_prompt
-        completion_to_prompt = completion_to_prompt or (lambda x: x)
+        completion_to_prompt = completion_to_prompt or _identity_completion_to_prompt
 
         generate_kwargs = generate_kwargs or {}
         generate_kwargs.update(
@@ -121,6 +303,7 @@ class LlamaCPP(CustomLLM):
         super().__init__(
             model_path=model_path,
             model_url=model_url,
+            model_sha256=model_sha256,
             temperature=temperature,
             context_window=context_window,
             max_new_tokens=max_new_tokens,
@@ -130,8 +313,34 @@ class LlamaCPP(CustomLLM):
             generate_kwargs=generate_kwargs,
             model_kwargs=model_kwargs,
             verbose=verbose,
+            n_gpu_layers=model_kwargs["n_gpu_layers"],
+            n_batch=model_kwargs["n_batch"],
+            tensor_split=model_kwargs.get("tensor_split"),
+            main_gpu=model_kwargs["main_gpu"],
+            use_mlock=model_kwargs["use_mlock"],
+            use_mmap=model_kwargs["use_mmap"],
+            f16_kv=model_kwargs["f16_kv"],
+            type_k=model_kwargs.get("type_k"),
+            type_v=model_kwargs.get("type_v"),
+            tensorcores=tensorcores,
+            prompt_cache_capacity=prompt_cache_capacity,
+        )
+
+        # load the model in the background, so that several models can be
+        # constructed back-to-back while their weights are loading
+        self._model_future = _MODEL_LOAD_EXECUTOR.submit(
+            _load_model,
+            llama_cpp,
+            model_path,
+            dict(model_kwargs),
+            prompt_cache_capacity,
         )
 
+    @property
+    def _model(self) -> Any:
+        """The llama-cpp model, waiting for it to finish loading if needed."""
+        return self._model_future.result()
+
     @property
     def metadata(self) -> LLMMetadata:
         """LLM metadata."""
@@ -141,34 +350,133 @@ class LlamaCPP(CustomLLM):
             model_name=self.model_path,
         )
 
-    def _download_url(self, model_url: str, model_path: str) -> None:
+    def _download_url(
+        self, model_url: str, model_path: str, expected_sha256: Optional[str] = None
+    ) -> None:
+        # download into a temporary file, keeping it (and the progress of each
+        # range) on failure so that a retry only fetches the missing bytes
+        part_path = model_path + ".part"
+        state_path = part_path + ".json"
         completed = False
+        resumable: Optional[bool] = None
+        ranges: List[List[int]] = []
+        response = None
         try:
             print("Downloading url", model_url, "to path", model_path)
-            with requests.get(model_url, stream=True) as r:
-                with open(model_path, "wb") as file:
-                    total_size = int(r.headers.get("Content-Length") or "0")
-                    if total_size < 1000 * 1000:
-                        raise ValueError(
-                            "Content should be at least 1 MB, but is only",
-                            r.headers.get("Content-Length"),
-                            "bytes",
-                        )
-                    print("total size (MB):", round(total_size / 1000 / 1000, 2))
-                    chunk_size = 1024 * 1024  # 1 MB
-                    for chunk in tqdm(
-                        r.iter_content(chunk_size=chunk_size),
-                        total=int(total_size / chunk_size),
-                    ):
-                        file.write(chunk)
+            head = _head(model_url)
+            if head is None or not head.headers.get("Content-Length"):
+                # some servers (e.g. presigned URLs) only allow GET, so fall back
+                # to a single stream without ranges
+                response = requests.get(model_url, stream=True)
+                response.raise_for_status()
+                info = response
+                resumable = False
+            else:
+                info = head
+                resumable = info.headers.get("Accept-Ranges") == "bytes"
+            headers = info.headers
+            total_size = int(headers.get("Content-Length") or "0")
+            if total_size < 1000 * 1000:
+                raise ValueError(
+                    "Content should be at least 1 MB, but is only",
+                    headers.get("Content-Length"),
+                    "bytes",
+                )
+            print("total size (MB):", round(total_size / 1000 / 1000, 2))
+            expected_sha256 = expected_sha256 or _linked_sha256(info)
+
+            # each range is [next byte to write, last byte]
+            if resumable and os.path.exists(part_path):
+                ranges = _load_download_state(state_path, total_size)
+            if ranges:
+                print("Resuming partially downloaded file.")
+            else:
+                # preallocate the file so each connection can write its own slice
+                with open(part_path, "wb") as file:
+                    file.truncate(total_size)
+                num_connections = DOWNLOAD_NUM_CONNECTIONS if resumable else 1
+                part_size = -(-total_size // num_connections)
+                ranges = [
+                    [start, min(start + part_size, total_size) - 1]
+                    for start in range(0, total_size, part_size)
+                ]
+
+            progress = tqdm(total=total_size, unit="B", unit_scale=True)
+            progress.update(total_size - sum(e - s + 1 for s, e in ranges))
+            progress_lock = threading.Lock()
+            cancelled = threading.Event()
+
+            def download_range(byte_range: List[int]) -> None:
+                nonlocal resumable
+                start, end = byte_range
+                if start > end:
+                    return
+                if response is not None:
+                    r = response
+                else:
+                    range_headers = {}
+                    if resumable:
+                        range_headers["Range"] = f"bytes={start}-{end}"
+                    r = requests.get(model_url, headers=range_headers, stream=True)
+                with r:
+                    r.raise_for_status()
+                    if resumable and r.status_code != 206:
+                        resumable = False
+                        raise ValueError("Server did not return the requested range.")
+                    with open(part_path, "r+b") as file:
+                        file.seek(start)
+                        for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                            if cancelled.is_set():
+                                return
+                            file.write(chunk)
+                            byte_range[0] += len(chunk)
+                            with progress_lock:
+                                progress.update(len(chunk))
+                if byte_range[0] != end + 1:
+                    raise ValueError("Received fewer bytes than requested.")
+
+            with progress, ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                futures = [executor.submit(download_range, r) for r in ranges]
+                try:
+                    done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+                finally:
+                    # stop the other connections on failure or interrupt
+                    cancelled.set()
+                for future in done:
+                    future.result()
+
+            if expected_sha256 is not None:
+                # the file was just written, so hashing it is served from page cache
+                sha256 = _file_sha256(part_path)
+                if sha256 != expected_sha256.lower():
+                    resumable = False
+                    raise ValueError(
+                        f"SHA256 mismatch: expected {expected_sha256}, got {sha256}."
+                    )
+
+            os.replace(part_path, model_path)
+            with open(model_path + ".size", "w") as f:
+                f.write(str(total_size))
+            if os.path.exists(state_path):
+                os.remove(state_path)
             completed = True
         except Exception as e:
             print("Error downloading model:", e)
         finally:
+            if response is not None:
+                response.close()
             if not completed:
-                print("Download incomplete.", "Removing partially downloaded file.")
-                os.remove(model_path)
-                raise ValueError("Download incomplete.")
+                if resumable and ranges:
+                    print("Download incomplete.", "Keeping partial file to resume.")
+                    with open(state_path, "w") as f:
+                        json.dump({"size": total_size, "ranges": ranges}, f)
+                elif resumable is False:
+                    print("Download incomplete.", "Removing partially downloaded file.")
+                    for path in (part_path, state_path):
+                        if os.path.exists(path):
+                            os.remove(path)
+        if not completed:
+            raise ValueError("Download incomplete.")
 
     @llm_chat_callback()
     def chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
@@ -186,25 +494,54 @@ class LlamaCPP(CustomLLM):
 
     @llm_completion_callback()
     def complete(self, prompt: str, **kwargs: Any) -> CompletionResponse:
-        self.generate_kwargs.update({"stream": False})
-        prompt = self.completion_to_prompt(prompt)
+        call_kwargs = {**self.generate_kwargs, **kwargs, "stream": False}
+        if self.completion_to_prompt is not _identity_completion_to_prompt:
+            prompt = self.completion_to_prompt(prompt)
 
-        response = self._model(prompt=prompt, **self.generate_kwargs)
+        response = self._model(prompt=prompt, **call_kwargs)
 
         return CompletionResponse(text=response["choices"][0]["text"], raw=response)
 
+    def batch_complete(
+        self, prompts: Sequence[str], **kwargs: Any
+    ) -> List[CompletionResponse]:
+        """Complete a batch of prompts, one at a time.
+
+        This is not a single llama.cpp batch: each prompt is a separate `complete`
+        call. llama.cpp keeps the KV cache of the previous call and only evaluates
+        the tokens after the longest common prefix, so prompts are processed in
+        sorted order to decode shared prefixes (e.g. system prompts) once.
+        Responses are returned in the order of `prompts`.
+        """
+        responses: List[Optional[CompletionResponse]] = [None] * len(prompts)
+        for i in sorted(range(len(prompts)), key=lambda i: prompts[i]):
+            responses[i] = self.complete(prompts[i], **kwargs)
+        return cast(List[CompletionResponse], responses)
+
     @llm_completion_callback()
-    def stream_complete(self, prompt: str, **kwargs: Any) -> CompletionResponseGen:
-        self.generate_kwargs.update({"stream": True})
-        prompt = self.completion_to_prompt(prompt)
+    def stream_complete(
+        self, prompt: str, include_raw: bool = False, **kwargs: Any
+    ) -> CompletionResponseGen:
+        """Stream a completion.
+
+        Unless `include_raw` is set, the raw llama.cpp response is only attached
+        to the final chunk, so streamed chunks don't keep every token's response.
+        """
+        call_kwargs = {**self.generate_kwargs, **kwargs, "stream": True}
+        if self.completion_to_prompt is not _identity_completion_to_prompt:
+            prompt = self.completion_to_prompt(prompt)
 
-        response_iter = self._model(prompt=prompt, **self.generate_kwargs)
+        response_iter = self._model(prompt=prompt, **call_kwargs)
 
         def gen() -> CompletionResponseGen:
             text = ""
             for response in response_iter:
-                delta = response["choices"][0]["text"]
+                choice = response["choices"][0]
+                delta = choice["text"]
                 text += delta
-                yield CompletionResponse(delta=delta, text=text, raw=response)
+                is_last = choice.get("finish_reason") is not None
+                raw = response if include_raw or is_last else None
+                # NOTE: skip pydantic validation per token, fields are already typed
+                yield CompletionResponse.construct(delta=delta, text=text, raw=raw)
 
         return gen()
@@ -0,0 +1,415 @@
+"""Test LlamaCPP."""
+
+import hashlib
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from unittest.mock import MagicMock
+
+import pytest
+import requests
+
+import llama_index.llms.llama_cpp as llama_cpp_module
+from llama_index.llms.base import ChatMessage
+from llama_index.llms.llama_cpp import LlamaCPP, _import_llama_cpp, _is_downloaded
+
+MODEL_URL = "https://example.com/model.bin"
+CHUNK_SIZE = 64 * 1024
+DATA = os.urandom(2 * 1024 * 1024)
+
+
+class MockResponse:
+    """Mock streamed `requests` response."""
+
+    def __init__(
+        self,
+        status_code: int,
+        headers: Dict[str, str],
+        content: bytes = b"",
+        fail_after: Optional[int] = None,
+        server: Optional["MockServer"] = None,
+    ) -> None:
+        self.status_code = status_code
+        self.headers = headers
+        self.history: List[Any] = []
+        self._content = content
+        self._fail_after = fail_after
+        self._server = server
+
+    def __enter__(self) -> "MockResponse":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def raise_for_status(self) -> None:
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} error")
+
+    def iter_content(self, chunk_size: int) -> Iterator[bytes]:
+        for i in range(0, len(self._content), chunk_size):
+            if self._fail_after is not None and i >= self._fail_after:
+                raise requests.ConnectionError("connection reset")
+            chunk = self._content[i : i + chunk_size]
+            if self._server is not None:
+                time.sleep(self._server.chunk_delay)
+                with self._server.lock:
+                    self._server.bytes_sent += len(chunk)
+            yield chunk
+
+
+class MockServer:
+    """Mock HTTP server serving `DATA`, optionally failing once mid-range."""
+
+    def __init__(self, partial: bool = True, fail_at: Optional[int] = None) -> None:
+        self.partial = partial
+        self.fail_at = fail_at
+        self.head_status = 200
+        self.head_content_length = True
+        self.chunk_delay = 0.0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        self.requested_ranges: List[Tuple[int, int]] = []
+
+    def head(self, url: str, **kwargs: Any) -> MockResponse:
+        headers = {"Accept-Ranges": "bytes"}
+        if self.head_content_length:
+            headers["Content-Length"] = str(len(DATA))
+        return MockResponse(self.head_status, headers)
+
+    def get(
+        self, url: str, headers: Optional[Dict[str, str]] = None, **kwargs: Any
+    ) -> MockResponse:
+        headers = headers or {}
+        if "Range" not in headers or not self.partial:
+            return MockResponse(
+                200, {"Content-Length": str(len(DATA))}, DATA, server=self
+            )
+
+        start, end = (int(x) for x in headers["Range"][len("bytes=") :].split("-"))
+        self.requested_ranges.append((start, end))
+        fail_after = None
+        if self.fail_at is not None and start <= self.fail_at <= end:
+            fail_after = self.fail_at - start
+            self.fail_at = None
+        return MockResponse(206, {}, DATA[start : end + 1], fail_after, server=self)
+
+
+class FakeLlama:
+    """Fake `llama_cpp.Llama` recording its kwargs and calls."""
+
+    def __init__(self, model_path: str, **kwargs: Any) -> None:
+        self.model_path = model_path
+        self.kwargs = kwargs
+        self.calls: List[Tuple[str, Dict[str, Any]]] = []
+
+    def __call__(self, prompt: str, **kwargs: Any) -> Any:
+        self.calls.append((prompt, kwargs))
+        if kwargs["stream"]:
+            return iter(
+                {"choices": [{"text": text, "finish_reason": finish_reason}]}
+                for text, finish_reason in [("a", None), ("b", None), ("c", "stop")]
+            )
+        return {"choices": [{"text": f"echo: {prompt}", "finish_reason": "stop"}]}
+
+
+@pytest.fixture()
+def fake_llama_cpp(monkeypatch: pytest.MonkeyPatch) -> MagicMock:
+    fake_llama_cpp = MagicMock()
+    fake_llama_cpp.Llama = FakeLlama
+    fake_llama_cpp.llama_cpp.llama_supports_gpu_offload.return_value = False
+    monkeypatch.setitem(sys.modules, "llama_cpp", fake_llama_cpp)
+    # NOTE: a None entry makes importing the tensor-core build fail
+    monkeypatch.setitem(sys.modules, "llama_cpp_cuda_tensorcores", None)
+    return fake_llama_cpp
+
+
+@pytest.fixture()
+def model_path(tmp_path: Any) -> str:
+    model_path = tmp_path / "existing.bin"
+    model_path.write_bytes(b"model")
+    return str(model_path)
+
+
+@pytest.fixture()
+def server(monkeypatch: pytest.MonkeyPatch) -> MockServer:
+    server = MockServer()
+    monkeypatch.setattr(requests, "head", server.head)
+    monkeypatch.setattr(requests, "get", server.get)
+    monkeypatch.setattr(llama_cpp_module, "DOWNLOAD_CHUNK_SIZE", CHUNK_SIZE)
+    return server
+
+
+@pytest.fixture()
+def llm(fake_llama_cpp: MagicMock, model_path: str) -> LlamaCPP:
+    return LlamaCPP(model_path=model_path)
+
+
+def test_n_gpu_layers(fake_llama_cpp: MagicMock, model_path: str) -> None:
+    llm = LlamaCPP(model_path=model_path)
+
+    # -1 is forwarded as an explicit layer count, the field keeps the user's value
+    assert llm.n_gpu_layers == -1
+    assert llm._model.kwargs["n_gpu_layers"] == llama_cpp_module.ALL_GPU_LAYERS
+
+    llm = LlamaCPP(model_path=model_path, n_gpu_layers=10)
+    assert llm.n_gpu_layers == 10
+    assert llm._model.kwargs["n_gpu_layers"] == 10
+
+    with pytest.raises(ValueError):
+        LlamaCPP(model_path=model_path, model_kwargs={"n_gpu_layers": None})
+
+
+def test_model_kwargs_override_constructor_args(
+    fake_llama_cpp: MagicMock, model_path: str
+) -> None:
+    llm = LlamaCPP(
+        model_path=model_path,
+        n_gpu_layers=10,
+        n_batch=8,
+        model_kwargs={"n_gpu_layers": 0, "n_batch": 16},
+    )
+
+    assert llm.n_gpu_layers == 0
+    assert llm.n_batch == 16
+    assert llm._model.kwargs["n_gpu_layers"] == 0
+    assert llm._model.kwargs["n_batch"] == 16
+    assert llm._model.kwargs["use_mmap"] is True
+
+
+def test_model_load_error_is_raised_on_first_use(
+    fake_llama_cpp: MagicMock, model_path: str
+) -> None:
+    fake_llama_cpp.Llama = MagicMock(side_effect=RuntimeError("failed to load"))
+
+    # the model loads in the background, so construction does not raise
+    llm = LlamaCPP(model_path=model_path)
+
+    with pytest.raises(RuntimeError, match="failed to load"):
+        llm.complete("hello")
+
+
+def test_call_kwargs_do_not_mutate_generate_kwargs(llm: LlamaCPP) -> None:
+    generate_kwargs = dict(llm.generate_kwargs)
+
+    llm.complete("hello", top_p=0.5)
+    list(llm.stream_complete("hello", top_p=0.7))
+
+    assert llm.generate_kwargs == generate_kwargs
+    (_, complete_kwargs), (_, stream_kwargs) = llm._model.calls
+    assert complete_kwargs["top_p"] == 0.5
+    assert complete_kwargs["stream"] is False
+    assert stream_kwargs["top_p"] == 0.7
+    assert stream_kwargs["stream"] is True
+    assert complete_kwargs["max_tokens"] == generate_kwargs["max_tokens"]
+
+
+def test_stream_complete_raw(llm: LlamaCPP) -> None:
+    responses = list(llm.stream_complete("hello"))
+
+    # only the final chunk (with a finish_reason) keeps the raw response
+    assert [response.delta for response in responses] == ["a", "b", "c"]
+    assert responses[-1].text == "abc"
+    assert [response.raw is not None for response in responses] == [
+        False,
+        False,
+        True,
+    ]
+    assert responses[-1].raw["choices"][0]["finish_reason"] == "stop"
+
+    responses = list(llm.stream_complete("hello", include_raw=True))
+    assert all(response.raw is not None for response in responses)
+    assert "include_raw" not in llm._model.calls[-1][1]
+
+
+def test_stream_chat_raw(llm: LlamaCPP) -> None:
+    messages = [ChatMessage(content="hello")]
+
+    responses = list(llm.stream_chat(messages))
+    assert [response.raw is not None for response in responses] == [
+        False,
+        False,
+        True,
+    ]
+
+    responses = list(llm.stream_chat(messages, include_raw=True))
+    assert all(response.raw is not None for response in responses)
+
+
+def test_batch_complete(llm: LlamaCPP) -> None:
+    prompts = ["c", "a", "b"]
+    responses = llm.batch_complete(prompts, top_p=0.5)
+
+    # prompts run in sorted order, responses come back in input order
+    assert [response.text for response in responses] == [
+        "echo: c",
+        "echo: a",
+        "echo: b",
+    ]
+    assert [prompt for prompt, _ in llm._model.calls] == ["a", "b", "c"]
+    assert all(kwargs["top_p"] == 0.5 for _, kwargs in llm._model.calls)
+
+
+def test_import_prefers_tensorcores_build(
+    fake_llama_cpp: MagicMock, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    tensorcores_build = MagicMock()
+    monkeypatch.setitem(sys.modules, "llama_cpp_cuda_tensorcores", tensorcores_build)
+
+    assert _import_llama_cpp(tensorcores=True, n_gpu_layers=-1) is tensorcores_build
+    assert _import_llama_cpp(tensorcores=False, n_gpu_layers=-1) is fake_llama_cpp
+
+
+def test_import_warns_once_without_tensorcores_build(
+    fake_llama_cpp: MagicMock,
+    monkeypatch: pytest.MonkeyPatch,
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    monkeypatch.setattr(llama_cpp_module, "_warned_missing_tensorcores", False)
+    fake_llama_cpp.llama_cpp.llama_supports_gpu_offload.return_value = True
+
+    with caplog.at_level(logging.WARNING, logger=llama_cpp_module.__name__):
+        assert _import_llama_cpp(tensorcores=False, n_gpu_layers=-1) is fake_llama_cpp
+        assert not caplog.records
+
+        for _ in range(3):
+            llama_cpp = _import_llama_cpp(tensorcores=True, n_gpu_layers=-1)
+            assert llama_cpp is fake_llama_cpp
+    assert len(caplog.records) == 1
+
+
+def test_download(server: MockServer, llm: LlamaCPP, tmp_path: Any) -> None:
+    model_path = str(tmp_path / "model.bin")
+    llm._download_url(MODEL_URL, model_path, hashlib.sha256(DATA).hexdigest())
+
+    with open(model_path, "rb") as f:
+        assert f.read() == DATA
+    assert len(server.requested_ranges) == llama_cpp_module.DOWNLOAD_NUM_CONNECTIONS
+    assert sorted(server.requested_ranges)[0][0] == 0
+    assert sorted(server.requested_ranges)[-1][1] == len(DATA) - 1
+    assert _is_downloaded(model_path)
+    assert not os.path.exists(model_path + ".part")
+    assert not os.path.exists(model_path + ".part.json")
+
+
+@pytest.mark.parametrize("head_status,head_content_length", [(405, True), (200, False)])
+def test_download_falls_back_to_get(
+    server: MockServer,
+    llm: LlamaCPP,
+    tmp_path: Any,
+    head_status: int,
+    head_content_length: bool,
+) -> None:
+    model_path = str(tmp_path / "model.bin")
+    server.head_status = head_status
+    server.head_content_length = head_content_length
+
+    llm._download_url(MODEL_URL, model_path)
+
+    with open(model_path, "rb") as f:
+        assert f.read() == DATA
+    assert not server.requested_ranges
+
+
+def test_download_cancels_on_first_failure(
+    server: MockServer, llm: LlamaCPP, tmp_path: Any
+) -> None:
+    model_path = str(tmp_path / "model.bin")
+    # the last range fails straight away while the others are still streaming
+    part_size = len(DATA) // llama_cpp_module.DOWNLOAD_NUM_CONNECTIONS
+    server.fail_at = len(DATA) - part_size
+    server.chunk_delay = 0.05
+
+    with pytest.raises(ValueError):
+        llm._download_url(MODEL_URL, model_path)
+    assert server.bytes_sent < len(DATA) // 2
+
+
+def test_download_resume(server: MockServer, llm: LlamaCPP, tmp_path: Any) -> None:
+    model_path = str(tmp_path / "model.bin")
+    part_size = len(DATA) // llama_cpp_module.DOWNLOAD_NUM_CONNECTIONS
+    fail_at = part_size + 2 * CHUNK_SIZE
+    server.fail_at = fail_at
+
+    with pytest.raises(ValueError):
+        llm._download_url(MODEL_URL, model_path)
+    assert os.path.exists(model_path + ".part")
+    assert os.path.exists(model_path + ".part.json")
+
+    server.requested_ranges = []
+    llm._download_url(MODEL_URL, model_path)
+
+    with open(model_path, "rb") as f:
+        assert f.read() == DATA
+    # only the remaining bytes are requested again
+    assert (fail_at, 2 * part_size - 1) in server.requested_ranges
+    assert all(start != part_size for start, _ in server.requested_ranges)
+    assert sum(end - start + 1 for start, end in server.requested_ranges) < len(DATA)
+    assert not os.path.exists(model_path + ".part.json")
+
+
+def test_download_without_range_support(
+    server: MockServer, llm: LlamaCPP, tmp_path: Any
+) -> None:
+    model_path = str(tmp_path / "model.bin")
+    server.partial = False
+
+    with pytest.raises(ValueError):
+        llm._download_url(MODEL_URL, model_path)
+    assert not os.path.exists(model_path)
+    assert not os.path.exists(model_path + ".part")
+    assert not os.path.exists(model_path + ".part.json")
+
+
+def test_download_sha256_mismatch(
+    server: MockServer, llm: LlamaCPP, tmp_path: Any
+) -> None:
+    model_path = str(tmp_path / "model.bin")
+
+    with pytest.raises(ValueError):
+        llm._download_url(MODEL_URL, model_path, "0" * 64)
+    assert not os.path.exists(model_path)
+    assert not os.path.exists(model_path + ".part")
+    assert not os.path.exists(model_path + ".part.json")
+
+
+def test_is_downloaded(tmp_path: Any) -> None:
+    model_path = str(tmp_path / "model.bin")
+    assert not _is_downloaded(model_path)
+
+    # without a recorded size, anything under 1 MB is considered truncated
+    with open(model_path, "wb") as f:
+        f.write(b"0" * 1000)
+    assert not _is_downloaded(model_path)
+
+    with open(model_path + ".size", "w") as f:
+        f.write("1000")
+    assert _is_downloaded(model_path)
+
+    with open(model_path + ".size", "w") as f:
+        f.write("2000")
+    assert not _is_downloaded(model_path)
+
+
+def test_truncated_model_is_downloaded_again(
+    server: MockServer,
+    fake_llama_cpp: MagicMock,
+    monkeypatch: pytest.MonkeyPatch,
+    tmp_path: Any,
+) -> None:
+    monkeypatch.setattr(llama_cpp_module, "get_cache_dir", lambda: str(tmp_path))
+    model_path = tmp_path / "models" / "model.bin"
+    model_path.parent.mkdir()
+    model_path.write_bytes(DATA[:1000])
+
+    llm = LlamaCPP(model_url=MODEL_URL)
+
+    assert llm.model_path == str(model_path)
+    assert model_path.read_bytes() == DATA
+    assert server.requested_ranges